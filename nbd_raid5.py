@@ -11,6 +11,7 @@
 import os
 import numpy as np
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 
 DiskGeometry = namedtuple('DiskGeometry', 'id raid_index fname startKB endKB')
@@ -21,6 +22,8 @@ pagesizeKB = -1
 
 API_VERSION = 2
 
+PREFETCH_PAGES = 8   # Pages per disk announced in advance with posix_fadvise
+
 
 def config(key, value):
     global geometry_file
@@ -34,61 +37,121 @@ def config(key, value):
         print("ignored parameter %s=%s" % (key, value))
 
 
+_geometry_cache = None
+_geometry_mtime = None
+
+
+def get_geometry():
+    '''Parse the geometry file once, reloading only when it changes on disk'''
+    global _geometry_cache, _geometry_mtime
+
+    mtime = os.path.getmtime(geometry_file)
+    if _geometry_cache is None or mtime != _geometry_mtime:
+        _geometry_cache = read_geometry(geometry_file)
+        _geometry_mtime = mtime
+    return _geometry_cache
+
+
 def open(readonly):
     fd = {}
-    geometry = read_geometry(geometry_file)
+    geometry = get_geometry()
+    for image in geometry:
+        fd[image.id] = os.open(image.fname, os.O_RDONLY)
+        os.posix_fadvise(fd[image.id], 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    ndisks = len(set([image.raid_index for image in geometry]))
+    sizeKB = sum(image.endKB - image.startKB for image in geometry)
+    # raid5_stripes depends on the page index only through page % ndisks,
+    # so its argsort has just ndisks distinct outcomes: compute them all
+    sort_orders = [tuple(int(i) for i in np.argsort(raid5_stripes(ndisks, p))[1:])
+                   for p in range(ndisks)]
+    # Everything derivable from the geometry is computed once here,
+    # so the per-request callbacks just look it up
+    return {'geometry': geometry,
+            'fd': fd,
+            'ndisks': ndisks,
+            'raidpagesize': pagesizeKB * 1024 * (ndisks - 1),
+            'size': sizeKB * 1024 * (ndisks - 1) // ndisks,
+            'by_raidx': build_lookup(geometry, fd),
+            'sort_orders': sort_orders,
+            'executor': ThreadPoolExecutor(max_workers=max(ndisks - 1, 1)),
+            'advised': {},   # Per-fd end of the last POSIX_FADV_WILLNEED window
+            }
+
+
+def build_lookup(geometry, fd):
+    '''Map raid_index -> list of (startKB, endKB, fd), sorted by startKB'''
+    by_raidx = {}
     for image in geometry:
-        fd[image.id] = builtin_open(image.fname, 'rb')
-    return (geometry, fd)
+        by_raidx.setdefault(image.raid_index, []).append(
+            (image.startKB, image.endKB, fd[image.id]))
+    for segments in by_raidx.values():
+        segments.sort()
+    return by_raidx
+
+
+def close(h):
+    h['executor'].shutdown()
+    for f in h['fd'].values():
+        os.close(f)
+
+
+def _read_stripe_into(task):
+    '''Read stripe data straight into a destination buffer slice.
+    os.preadv is thread-safe: no shared seek pointer'''
+    fd, offset, dest = task
+    os.preadv(fd, [dest], offset)
 
 
 def get_size(h):
-    geometry, fd = h
+    return h['size']
 
-    sizesKB = [(image.endKB - image.startKB) for image in geometry]
-    ndisks = len(set([image.raid_index for image in geometry]))
-    return sum(sizesKB) * 1024 * (ndisks-1) // ndisks
-      
 
 def pread(h, buf, offset, flags):
-    geometry, fd = h
-
-    ndisks = len(set([image.raid_index for image in geometry]))
-    raidpagesize = pagesizeKB * 1024 * (ndisks - 1)
+    ndisks = h['ndisks']
+    by_raidx = h['by_raidx']
+    advised = h['advised']
+    raidpagesize = h['raidpagesize']
+    sort_orders = h['sort_orders']
+    stripe_bytes = pagesizeKB * 1024
     start_page = offset // raidpagesize
-    end_page = (offset + len(buf)) // raidpagesize + 1 
-    mod_page = offset % raidpagesize
-    pos = 0
+    end_page = (offset + len(buf)) // raidpagesize + 1
+    view = memoryview(buf)
     for page in range(start_page, end_page):
-        stripes = raid5_stripes(ndisks, page)  # RAID stripes ordering in given page
-        sorted_idxs = np.argsort(stripes)[1:]   # sorted RAID disks to read, excluding parity
+        sorted_idxs = sort_orders[page % ndisks]   # sorted RAID disks to read, excluding parity
 
         pageKB = page * pagesizeKB  # Page KB address on the single disk
 
-        # Read stripes in order
-        mybuf = []
-        for raid_idx in sorted_idxs:
-            for image in geometry:
-                if image.raid_index == raid_idx and image.startKB <= pageKB and image.endKB > pageKB:
+        # Intersect each stripe with the requested range and resolve it to a
+        # (fd, file offset, destination slice) task writing straight into buf,
+        # with no intermediate per-page assembly buffer
+        tasks = []
+        page_start = page * raidpagesize   # Page position on the virtual disk
+        for n, raid_idx in enumerate(sorted_idxs):
+            stripe_start = page_start + n * stripe_bytes
+            cut_start = max(stripe_start, offset)
+            cut_end = min(stripe_start + stripe_bytes, offset + len(buf))
+            if cut_start >= cut_end:
+                continue
+            for startKB, endKB, image_fd in by_raidx[raid_idx]:
+                if startKB <= pageKB and endKB > pageKB:
                     # Image files are at multiples of page size,
                     # so there is no need to split reads
-                    myoffset = pageKB - image.startKB
-                    fd[image.id].seek(myoffset * 1024)
-                    mybuf.append(fd[image.id].read(pagesizeKB * 1024))
-
-        # Assemble full RAID page and cut start and end if needed
-        mybuf = b''.join(mybuf)
-        mybuf = mybuf[mod_page:]
-
-        if pos + len(mybuf) > len(buf):
-            mylen = len(buf) - pos
-        else:
-            mylen = len(mybuf)
-        if mylen == 0:
-            break
-        buf[pos : pos + mylen] = mybuf[:mylen]
-        pos += mylen
-        mod_page = 0   # No need to cut the start position after the first page
+                    myoffset = (pageKB - startKB) * 1024 + (cut_start - stripe_start)
+                    tasks.append((image_fd, myoffset,
+                                  view[cut_start - offset : cut_end - offset]))
+                    break
+
+        # Hint the kernel about the next stripes on each disk, so
+        # readahead overlaps with serving the current page
+        for taskfd, taskoff, dest in tasks:
+            next_off = taskoff + stripe_bytes
+            if next_off + stripe_bytes > advised.get(taskfd, 0):
+                os.posix_fadvise(taskfd, next_off, stripe_bytes * PREFETCH_PAGES,
+                                 os.POSIX_FADV_WILLNEED)
+                advised[taskfd] = next_off + stripe_bytes * PREFETCH_PAGES
+
+        # Read all stripes of this page in parallel
+        list(h['executor'].map(_read_stripe_into, tasks))
 
 
 def raid5_stripes(ndisks, page_index, start=0):
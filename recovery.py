@@ -22,16 +22,22 @@ python recovery.py -v --image-file start4.img --image-file start8.img --image-fi
 import os
 import sys
 import glob
+import mmap
 import argparse
-import operator
 import itertools
 import functools
-from collections import defaultdict
+from collections import defaultdict, deque
 from collections.abc import Sequence
 import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from tqdm import tqdm
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 class ArgumentException(Exception):
     pass
@@ -56,34 +62,146 @@ def _parse_range(rangestr):
             
 
 def read_page(fname, pagesize, page):
-    with open(fname, 'rb') as f:
+    # buffering=0: a full page is read in one go, the BufferedReader layer
+    # would only add a copy and its read-ahead is thrown away by the seek
+    with open(fname, 'rb', buffering=0) as f:
         f.seek(page * pagesize)
         byt = f.read(pagesize)
         return np.frombuffer(byt, dtype=np.uint8)
 
 
-def parity_check(data_chunks):
-    '''Check that data_chunks are a correct parity set'''
-    parity = functools.reduce(operator.xor, data_chunks[1:])
-    return np.array_equal(data_chunks[0], parity)
+def open_images(fnames):
+    '''Open all image files once, with sequential readahead hints'''
+    fds = {}
+    for fname in fnames:
+        fd = os.open(fname, os.O_RDONLY)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        fds[fname] = fd
+    return fds
+
+
+def close_images(fds):
+    for fd in fds.values():
+        os.close(fd)
+
+
+def read_page_fd(fd, pagesize, page):
+    byt = os.pread(fd, pagesize, page * pagesize)
+    return np.frombuffer(byt, dtype=np.uint8)
+
+
+def read_page_into(fd, pagesize, page, out):
+    '''Read a page into a preallocated buffer, avoiding per-call allocations'''
+    nread = os.preadv(fd, [out], page * pagesize)
+    if nread < len(out):
+        # A short read would leave uninitialized bytes in the buffer and
+        # turn the parity verdict into garbage: fail loudly instead
+        raise GenericException(f'Short read starting at page {page}: '
+                               f'got {nread} of {len(out)} bytes')
 
 
-def guess_set(fnames, ndisks, pagesize, pages, verbose=False, test_all=False):
+PARITY_PREFIX = 4096   # Bytes XOR-ed first to reject mismatching sets cheaply
+
+
+if numba is not None:
+    @numba.njit(cache=True, boundscheck=False)
+    def _fused_parity_check(chunks):
+        '''Single-pass XOR+compare over uint64 lanes. Row 0 is the parity
+        candidate. Makes one pass over memory and exits at the first
+        mismatching lane; LLVM vectorizes the inner XOR reduction.'''
+        for i in range(chunks.shape[1]):
+            x = chunks[1, i]
+            for k in range(2, chunks.shape[0]):
+                x ^= chunks[k, i]
+            if x != chunks[0, i]:
+                return False
+        return True
+
+
+def _xor_reduce(chunks):
+    '''XOR all chunks together in place, with a single temporary'''
+    parity = chunks[0].copy()
+    for chunk in chunks[1:]:
+        np.bitwise_xor(parity, chunk, out=parity)
+    return parity
+
+
+def parity_check(data_chunks):
+    '''Check that data_chunks are a correct parity set'''
+    # Freshly imaged disks have long runs of all-zero pages: if no chunk has
+    # a set bit the parity trivially matches, with no XOR work at all. Since
+    # ndarray.any() does not exit early, probe a tiny prefix first so that
+    # ordinary nonzero pages pay almost nothing for this check.
+    if not any(chunk[:64].any() for chunk in data_chunks):
+        if not any(chunk.any() for chunk in data_chunks):
+            return True
+
+    # View the pages as uint64 so each XOR lane carries 8 bytes instead of 1.
+    # XOR is bitwise, so the result is unchanged. Page sizes are whole KBs,
+    # thus always a multiple of 8 bytes, but fall back to uint8 just in case
+    if data_chunks[0].nbytes % 8 == 0:
+        chunks = [chunk.view(np.uint64) for chunk in data_chunks]
+    else:
+        chunks = data_chunks
+
+    # Most wrong candidate sets during raidset discovery mismatch within the
+    # first few bytes: work in tiles and stop at the first mismatching one
+    tile = PARITY_PREFIX // chunks[0].itemsize
+
+    if numba is not None:
+        # The kernel exits at the first mismatching lane, but np.stack
+        # copies its input first: stack just a prefix to keep rejects cheap
+        if len(chunks[0]) > tile:
+            if not _fused_parity_check(np.stack([c[:tile] for c in chunks])):
+                return False
+        return _fused_parity_check(np.stack(chunks))
+
+    for off in range(0, len(chunks[0]), tile):
+        s = slice(off, off + tile)
+        # bytes equality is a plain memcmp, several times faster than
+        # np.array_equal and its shape/broadcast logic at this tile size
+        if chunks[0][s].tobytes() != _xor_reduce([c[s] for c in chunks[1:]]).tobytes():
+            return False
+    return True
+
+
+def _quick_sig(data_chunks):
+    '''Parity signature over the first 64 bytes only: almost every wrong
+    combination already fails here, at a fraction of a full page check'''
+    x = data_chunks[1][:64].copy()
+    for chunk in data_chunks[2:]:
+        x ^= chunk[:64]
+    return x.tobytes() == data_chunks[0][:64].tobytes()
+
+
+def _check_page(page, fnames, ndisks, pagesize, test_all):
+    '''Parity-test all file combinations on a single page'''
+    # Read each file once per page: combinations share the cached pages
+    page_cache = {fname: read_page(fname, pagesize, page) for fname in fnames}
+    results = {}
+    for comb in itertools.combinations(fnames, ndisks):
+        data = [page_cache[fname] for fname in comb]
+        check = _quick_sig(data) and parity_check(data)
+        results[comb] = check
+        if check and not test_all:
+            break
+    return results
+
+
+def guess_set(fnames, ndisks, pagesize, pages, nproc=1, verbose=False, test_all=False):
     '''Guess which image files are part of a RAID5 sets, looking for matching parity data'''
 
     detected = defaultdict(list)
-    for page in tqdm(pages):
-        for comb in itertools.combinations(fnames, ndisks):
-            data = [read_page(fname, pagesize, page) for fname in comb]
-            check = parity_check(data)
-            if verbose:
-                print('Trying:', comb, 'Page:', page, 'Result:', 'Match' if check else 'No match')
-            if check:
-                detected[comb].append(True)
-                if not test_all:
-                    break
-            else:
-                detected[comb].append(False)
+    my_check_page = functools.partial(_check_page, fnames=fnames, ndisks=ndisks,
+                                      pagesize=pagesize, test_all=test_all)
+    chunksize = max(1, len(pages) // (nproc * 4))
+    with mp.Pool(nproc) as p:
+        for page, results in zip(pages, tqdm(p.imap(my_check_page, pages, chunksize=chunksize),
+                                             total=len(pages))):
+            for comb, check in results.items():
+                if verbose:
+                    print('Trying:', comb, 'Page:', page, 'Result:', 'Match' if check else 'No match')
+                detected[comb].append(check)
     good_combs = []
     for comb in detected:
         if all(detected[comb]):
@@ -102,57 +220,176 @@ def raid5_stripes(ndisks, page_index, start=0):
     return stripes
 
 
-def test_parity(fnames, pagesize, pages, verbose=False):
+def stripe_sort_orders(ndisks):
+    '''Stripe sort orders (parity excluded) indexed by page_index % ndisks.
 
-    passed = True
-    ndisks = len(fnames)
+    raid5_stripes depends on the page index only through page_index % ndisks,
+    so there are just ndisks distinct orderings: build them all once.'''
+    return [np.argsort(np.array(raid5_stripes(ndisks, p)))[1:] for p in range(ndisks)]
+
+
+RESTORE_BATCH = 64   # Contiguous pages processed together by each worker
+
+
+def _page_batches(pages, batchsize):
+    '''Split a page list into batches of contiguous pages'''
+    batch = []
     for page in pages:
-        stripes = np.array(raid5_stripes(ndisks, page))
-        data = [read_page(fname, pagesize, page) for fname in fnames]
-        check = parity_check(data)
-        if verbose:
-            print(f'Page {page}: parity check', 'passed' if check else 'FAILED')
-        if not check:
-            passed = False
-    print(f'Parity check ', 'passed' if check else 'FAILED')
+        if batch and (page != batch[-1] + 1 or len(batch) >= batchsize):
+            yield batch
+            batch = []
+        batch.append(page)
+    if batch:
+        yield batch
 
 
-def restore(fnames, pagesize_kB, pages, output_filename):
+# Per-worker state set up by the pool initializers below
+_worker = {}
 
-    ndisks = len(fnames)
-    pagesize = pagesize_kB * 1024
-    with open(output_filename, 'wb') as f:
-        for page in tqdm(pages, desc='Restoring image'):
-            stripes = np.array(raid5_stripes(ndisks, page))
-            data = [read_page(fname, pagesize, page) for fname in fnames]
-            if not parity_check(data):
-                raise GenericException(f'Parity check failed for page {page}')
 
-            sorted_idxs = np.argsort(stripes)[1:]  # First one is the parity (value -1)
-            for idx in sorted_idxs:
-                f.write(data[idx])
+def _parity_worker_init(fnames, pagesize):
+    '''Open the image files and allocate the batch buffer once per worker'''
+    _worker['fnames'] = fnames
+    _worker['pagesize'] = pagesize
+    _worker['fds'] = open_images(fnames)
+    _worker['buf'] = np.empty((len(fnames), RESTORE_BATCH * pagesize), dtype=np.uint8)
 
 
-def _is_ascii(page, fname, pagesize):
-    data = read_page(fname, pagesize, page)
+def _parity_batch(batch):
+    '''Parity-check a batch of contiguous pages, returning one bool per page'''
+    fnames = _worker['fnames']
+    pagesize = _worker['pagesize']
+    fds = _worker['fds']
+    nbatch = len(batch)
+    buf = _worker['buf'][:, :nbatch * pagesize]
+    for i, fname in enumerate(fnames):
+        # Batches are contiguous, so the whole batch is a single read
+        read_page_into(fds[fname], pagesize, batch[0], buf[i])
+    arr = buf.reshape(len(fnames), nbatch, pagesize)
+    parity = _xor_reduce(list(arr[1:]))
+    return list((parity == arr[0]).all(axis=1))
+
+
+def test_parity(fnames, pagesize, pages, nproc=1, verbose=False):
+
+    passed = True
+    batches = list(_page_batches(pages, RESTORE_BATCH))
+    with ProcessPoolExecutor(max_workers=nproc, initializer=_parity_worker_init,
+                             initargs=(fnames, pagesize)) as ex:
+        for batch, results in zip(batches, ex.map(_parity_batch, batches)):
+            for page, check in zip(batch, results):
+                if verbose:
+                    print(f'Page {page}: parity check', 'passed' if check else 'FAILED')
+                if not check:
+                    passed = False
+    print(f'Parity check ', 'passed' if passed else 'FAILED')
+
+
+def _restore_worker_init(fnames, pagesize):
+    '''Map the image files once in each worker process'''
+    files = [open(fname, 'rb') for fname in fnames]
+    mms = [mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) for f in files]
+    for mm in mms:
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    _worker['mms'] = mms
+    _worker['pagesize'] = pagesize
+    _worker['sort_orders'] = stripe_sort_orders(len(fnames))
+
+
+def _restore_batch(batch):
+    '''Parity-check and reassemble a batch of pages, returning raw bytes'''
+    mms = _worker['mms']
+    pagesize = _worker['pagesize']
+    sort_orders = _worker['sort_orders']
+    ndisks = len(mms)
+    nbatch = len(batch)
+
+    # Zero-copy views into the page cache, one batch per disk
+    data = [np.frombuffer(mm, dtype=np.uint8, count=nbatch * pagesize,
+                          offset=batch[0] * pagesize).reshape(nbatch, pagesize)
+            for mm in mms]
+
+    # Parity check of the whole batch at once, XOR-ing straight over the
+    # mmap views so only one batch-sized accumulator is ever allocated
+    parity = _xor_reduce(data[1:])
+    bad = (parity != data[0]).any(axis=1)
+    if bad.any():
+        raise GenericException(f'Parity check failed for page {batch[bad.argmax()]}')
+
+    # Assemble the batch in stripe order
+    out = np.empty((nbatch, ndisks - 1, pagesize), dtype=np.uint8)
+    for k, page in enumerate(batch):
+        sorted_idxs = sort_orders[page % ndisks]  # Parity already excluded
+        for j, idx in enumerate(sorted_idxs):
+            out[k, j] = data[idx][k]
+
+    # Drop the page cache behind us to bound memory usage
+    for mm in mms:
+        mm.madvise(mmap.MADV_DONTNEED, 0, (batch[-1] + 1) * pagesize)
+    return out.tobytes()
+
+
+def restore(fnames, pagesize_kB, pages, output_filename, nproc=1):
+
+    ndisks = len(fnames)
+    pagesize = pagesize_kB * 1024
+    batches = list(_page_batches(pages, RESTORE_BATCH))
+    with ProcessPoolExecutor(max_workers=nproc, initializer=_restore_worker_init,
+                             initargs=(fnames, pagesize)) as ex, \
+         open(output_filename, 'wb', buffering=8 * 1024 * 1024) as f, \
+         tqdm(total=len(pages), desc='Restoring image') as pbar:
+        # Preallocate the output to its final size to avoid fragmentation
+        os.posix_fallocate(f.fileno(), 0, len(pages) * (ndisks - 1) * pagesize)
+        # Keep only a small window of batches in flight: ex.map submits
+        # everything up front, and if the output device is slower than the
+        # workers, the completed-but-unwritten results pile up without bound.
+        # Writing the oldest batch before submitting a new one caps memory
+        # at ~2*nproc batch results while keeping every worker busy
+        pending = deque()
+        for batch in batches:
+            if len(pending) >= 2 * nproc:
+                done, future = pending.popleft()
+                f.write(future.result())
+                pbar.update(len(done))
+            pending.append((batch, ex.submit(_restore_batch, batch)))
+        while pending:
+            done, future = pending.popleft()
+            f.write(future.result())
+            pbar.update(len(done))
+
+
+def _ascii_worker_init(fname, pagesize):
+    '''Open the image file once per worker process'''
+    _worker['fd'] = os.open(fname, os.O_RDONLY)
+    _worker['pagesize'] = pagesize
+
+
+def _is_ascii(page):
+    data = read_page_fd(_worker['fd'], _worker['pagesize'], page)
     if data.sum() == 0:
         return '0'
     else:
-        uniq = len(np.unique(data))
+        # Only the number of distinct byte values matters: a fixed-size
+        # histogram gets it in O(n) instead of np.unique's sort
+        uniq = int((np.bincount(data, minlength=256) > 0).sum())
         return '1' if uniq < 80 else '0'
 
 
 def _find_parity_page(fname, ndisks, page_size_kB, pages, nproc=1, msg=''):
 
-    flags = []
+    # One byte per page: a bytearray avoids building millions of 1-char
+    # string objects and joining them afterwards
+    flags = bytearray(len(pages))
     pagesize = page_size_kB * 1024
-    with mp.Pool(nproc) as p:
-        my_is_ascii = functools.partial(_is_ascii, fname=fname, pagesize=pagesize)
-        flags = list(tqdm(p.imap(my_is_ascii, pages), total=len(pages), desc=msg))
-    allflags = ''.join(flags)
-    search_flags = ['1'] * (ndisks - 1) + ['0']
-    search_pattern = ''.join(search_flags * 2)
-    return allflags.find(search_pattern)
+    # Large chunks amortize the IPC cost of dispatching millions of
+    # fast per-page tasks; the file is opened once per worker
+    chunksize = max(64, len(pages) // (nproc * 8))
+    with mp.Pool(nproc, initializer=_ascii_worker_init, initargs=(fname, pagesize)) as p:
+        for i, flag in enumerate(tqdm(p.imap(_is_ascii, pages, chunksize=chunksize),
+                                      total=len(pages), desc=msg)):
+            flags[i] = ord(flag)
+    search_pattern = (b'1' * (ndisks - 1) + b'0') * 2
+    return bytes(flags).find(search_pattern)
 
 
 def guess_pagesize(fnames, array_size, nproc=1):
@@ -161,9 +398,13 @@ def guess_pagesize(fnames, array_size, nproc=1):
     '''
     sizesKB = [1024, 512, 256, 128, 64]
     ndisks = array_size
+    size = os.path.getsize(fnames[0])
+
+    # Candidate sizes are probed one after the other so the common case
+    # (an early match) stops after a single image scan; each probe already
+    # spreads its pages over an nproc-wide pool
     for szKB in sizesKB:
         # Recalc number of pages
-        size = os.path.getsize(fnames[0])
         pages = list(range(size // (szKB * 1024)))
         index = _find_parity_page(fnames[0], ndisks, szKB, pages, nproc, msg=f'Trying {szKB}KB')
         if index >= 0:
@@ -228,14 +469,15 @@ def main(args):
         pagesize = args.page_size
         if len(fnames) < 3:
             raise ArgumentException('Error: need at least 3 image files for parity check')
-        test_parity(fnames, pagesize * 1024, pages, verbose=args.verbose)
+        test_parity(fnames, pagesize * 1024, pages, nproc=args.nproc, verbose=args.verbose)
 
     elif args.subcommand == 'raidset':
         pagesize = args.page_size
         ndisks = args.array_size
         if len(fnames) < ndisks:
             raise ArgumentException(f'Not enough image files for array-size={ndisks} (only {len(fnames)} given)')
-        detected = guess_set(fnames, ndisks, pagesize * 1024, pages, verbose=args.verbose, test_all=args.test_all)
+        detected = guess_set(fnames, ndisks, pagesize * 1024, pages, nproc=args.nproc,
+                             verbose=args.verbose, test_all=args.test_all)
         if len(detected) == 0:
             print('No RAID5 set detected')
         else:
@@ -251,7 +493,7 @@ def main(args):
         pagesize = args.page_size
         if os.path.exists(args.output_filename):
             raise GenericException(f'{args.output_filename} already exist, nothing done')
-        restore(fnames, pagesize, pages, args.output_filename)
+        restore(fnames, pagesize, pages, args.output_filename, nproc=args.nproc)
 
 
 if __name__ == '__main__':